@@ -7,18 +7,6 @@ import time
 # Add src to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'src')))
 
-try:
-    from rag.query import query_system
-    from rag.ingest import build_pipeline
-    from vision.vision_processor import VisionProcessor
-    from llama_index.core import StorageContext, load_index_from_storage
-except ImportError:
-    # Fallback
-    from src.rag.query import query_system
-    from src.rag.ingest import build_pipeline
-    from src.vision.vision_processor import VisionProcessor
-    from llama_index.core import StorageContext, load_index_from_storage
-
 # --- Configuration ---
 st.set_page_config(
     page_title="Visual Fin-Analyst",
@@ -60,6 +48,35 @@ def check_password():
 if not check_password():
     st.stop()  # Stop execution if not logged in
 
+# --- Heavy Dependencies (LlamaIndex, YOLO) ---
+# Imported after login, once per process, so the login page stays light
+@st.cache_resource(show_spinner="Loading AI components...")
+def load_rag_components():
+    try:
+        from rag.query import query_system
+        from rag.ingest import build_pipeline
+        from vision.vision_processor import VisionProcessor
+    except ImportError:
+        # Fallback
+        from src.rag.query import query_system
+        from src.rag.ingest import build_pipeline
+        from src.vision.vision_processor import VisionProcessor
+    return query_system, build_pipeline, VisionProcessor
+
+query_system, build_pipeline, VisionProcessor = load_rag_components()
+
+@st.cache_resource(show_spinner="Loading table detector...")
+def load_vision_processor():
+    """One YOLO model for the whole server, instead of reloading weights per upload."""
+    return VisionProcessor()
+
+# --- Cached Helpers ---
+@st.cache_data(max_entries=2, show_spinner=False)
+def load_pdf_bytes(pdf_path, mtime):
+    """Reads the PDF once per (path, mtime) instead of on every rerun."""
+    with open(pdf_path, "rb") as f:
+        return f.read()
+
 # --- Main App Logic ---
 
 # Initialize Session State
@@ -110,8 +127,8 @@ with st.sidebar:
                 try:
                     # Step A: Table Extraction
                     progress_bar.progress(10, text="Detecting Tables (YOLOv8)...")
-                    vision = VisionProcessor(output_dir=table_output_dir)
-                    extracted_images = vision.process_pdf(pdf_path)
+                    vision = load_vision_processor()
+                    extracted_images = vision.process_pdf(pdf_path, output_dir=table_output_dir)
                     
                     st.success(f"👁️ Extracted {len(extracted_images)} tables")
                     
@@ -182,8 +199,7 @@ else:
         if os.path.exists(pdf_path):
             from streamlit_pdf_viewer import pdf_viewer
             # Streamlit Cloud needs binary reading
-            with open(pdf_path, "rb") as f:
-                pdf_bytes = f.read()
+            pdf_bytes = load_pdf_bytes(pdf_path, os.path.getmtime(pdf_path))
             pdf_viewer(input=pdf_bytes, width=700)
         else:
             st.warning("PDF file not found.")
@@ -221,12 +237,12 @@ else:
                     with st.spinner("Analyzing..."):
                         try:
                             target_storage = st.session_state.get("persist_dir", "./storage")
-                            result = query_system(prompt, persist_dir=target_storage) 
+                            result = query_system(prompt, persist_dir=target_storage, stream=True) 
                             
-                            response_text = result.get("response_text", "No response.")
                             source_images = result.get("source_images", [])
                             
-                            st.markdown(response_text)
+                            # Stream tokens as they arrive; returns the full text
+                            response_text = st.write_stream(result.get("response_text", iter(["No response."])))
                             
                             if source_images:
                                 with st.expander("🔍 Verified Source Tables", expanded=True):
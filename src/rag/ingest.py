@@ -1,37 +1,67 @@
 import os
 import glob
+import time
+import asyncio
+import hashlib
+import json
+import re
+import queue
+import tempfile
+import threading
 from dotenv import load_dotenv
 from llama_index.core import (
     Settings,
     VectorStoreIndex,
-    SimpleDirectoryReader,
     StorageContext,
     Document,
+    load_index_from_storage,
 )
 from llama_index.core.node_parser import SentenceSplitter
 try:
     from src.rag.openrouter_client import OpenRouterLLM, OpenRouterEmbedding
+    from src.rag.vector_store import EMBED_DIM, new_storage_context, load_storage_context, is_faiss_store, stored_embeddings
+    from src.rag.pdf_text import extract_pages
 except ImportError:
     from openrouter_client import OpenRouterLLM, OpenRouterEmbedding
-from llama_index.core.schema import TextNode
+    from vector_store import EMBED_DIM, new_storage_context, load_storage_context, is_faiss_store, stored_embeddings
+    from pdf_text import extract_pages
+from llama_index.core.schema import TextNode, MetadataMode
 
 # Load environment variables
 load_dotenv()
 
 # --- Configuration ---
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+VLM_CONCURRENCY = int(os.getenv("VLM_CONCURRENCY", "10"))  # Max in-flight VLM requests
+VLM_MAX_RETRIES = 5  # Client retries (429s back off exponentially) before giving up on a table
+VLM_BATCH_SIZE = int(os.getenv("VLM_BATCH_SIZE", "4"))  # Table images sent per VLM request
+VLM_CACHE_DIR = os.getenv("VLM_CACHE_DIR", "./cache/vlm")  # Table summaries keyed by image hash
+VLM_MAX_IMAGE_SIDE = 1024  # Long edge sent to the VLM ("high" detail tiles at this scale anyway)
+VLM_GRAYSCALE = os.getenv("VLM_GRAYSCALE", "0") == "1"  # Opt-in: ~2-3x smaller uploads, but drops colour
+# Public URL the VLM can fetch table images from (e.g. a bucket serving the project's data/ tree).
+# Unset: images are inlined as base64 data URLs.
+TABLE_IMAGE_BASE_URL = os.getenv("TABLE_IMAGE_BASE_URL")
+EMBED_BATCH_SIZE = 96  # Nodes per embedding request
+EMBED_BATCH_TIMEOUT = 2.0  # Seconds before a partial batch is flushed
+NODE_QUEUE_SIZE = 64  # Backpressure between producer stages and the embedder
+
+MANIFEST_FILE = "chunk_manifest.json"  # {chunk hash: node_id}, stored next to the index
+
+_STAGE_DONE = object()  # Sentinel a producer stage puts on the queue when finished
 
 # Initialize LLM (OpenRouter)
 # Models: "google/gemini-flash-1.5", "openai/gpt-4o", etc.
 llm = OpenRouterLLM(
     model="openai/gpt-4o-mini",
     api_key=OPENROUTER_API_KEY,
+    max_retries=VLM_MAX_RETRIES,
 )
 
 # Initialize Embeddings (OpenRouter)
 embed_model = OpenRouterEmbedding(
     model_name="openai/text-embedding-3-small", 
     api_key=OPENROUTER_API_KEY,
+    dimensions=EMBED_DIM,
 )
 
 # Set Global Settings
@@ -40,15 +70,56 @@ Settings.embed_model = embed_model
 Settings.chunk_size = 1024
 Settings.chunk_overlap = 20
 
-def summarize_table_image(image_path: str) -> str:
+def _vlm_image_path(image_path: str) -> str:
     """
-    Sends table image to VLM to get a text summary.
+    Table image to upload: the crop itself if it fits in VLM_MAX_IMAGE_SIDE, otherwise a
+    downscaled copy (grayscale too with VLM_GRAYSCALE=1) in a `vlm/` subfolder next to the
+    original, reused by later runs.
+    """
+    from PIL import Image
+
+    with Image.open(image_path) as img:  # Reads the header only
+        if max(img.size) <= VLM_MAX_IMAGE_SIDE and not VLM_GRAYSCALE:
+            return image_path
+
+    subfolder = "vlm_gray" if VLM_GRAYSCALE else "vlm"
+    resized_path = os.path.join(os.path.dirname(image_path), subfolder, os.path.basename(image_path))
+    if os.path.exists(resized_path) and os.path.getmtime(resized_path) >= os.path.getmtime(image_path):
+        return resized_path
+
+    with Image.open(image_path) as img:
+        if VLM_GRAYSCALE:
+            img = img.convert("L")
+        img.thumbnail((VLM_MAX_IMAGE_SIDE, VLM_MAX_IMAGE_SIDE))  # No-op if already small enough
+        os.makedirs(os.path.dirname(resized_path), exist_ok=True)
+        # Unique per writer: concurrent ingests may downscale the same crop
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(resized_path), suffix=".tmp", delete=False) as f:
+            img.save(f, format="PNG", optimize=True)
+    os.replace(f.name, resized_path)
+    return resized_path
+
+def _image_url(image_path: str) -> str:
+    """
+    URL the VLM fetches the table from: a hosted copy when TABLE_IMAGE_BASE_URL is set
+    (no base64 encoding, ~33% smaller request), otherwise an inline data URL.
+    Hosted crops are sent as-is (the bucket only mirrors the originals); inline ones
+    are downscaled first, see `_vlm_image_path`.
     """
+    if TABLE_IMAGE_BASE_URL:
+        from urllib.parse import quote
+        relative_path = os.path.relpath(os.path.abspath(image_path)).replace(os.sep, "/")
+        return f"{TABLE_IMAGE_BASE_URL.rstrip('/')}/{quote(relative_path)}"
+
     import base64
     
-    with open(image_path, "rb") as image_file:
+    with open(_vlm_image_path(image_path), "rb") as image_file:
         base64_image = base64.b64encode(image_file.read()).decode("utf-8")
-        
+    return f"data:image/png;base64,{base64_image}"
+
+def _table_summary_messages(image_path: str):
+    """
+    Builds the multimodal chat message asking the VLM to summarise a table image.
+    """
     # Construct Multimodal Message for OpenRouter/OpenAI-compatible
     # Note: LlamaIndex OpenAI class supports passing `image_url` in messages
     
@@ -56,7 +127,7 @@ def summarize_table_image(image_path: str) -> str:
 
     # Create content blocks
     image_block = ImageBlock(
-        url=f"data:image/png;base64,{base64_image}",
+        url=_image_url(image_path),
         detail="high"  # Optional, for OpenAI
     )
     
@@ -69,106 +140,393 @@ def summarize_table_image(image_path: str) -> str:
     
     text_block = TextBlock(text=prompt_text)
     
-    # Send request
-    try:
-        response = llm.chat(
-            messages=[
-                ChatMessage(
-                    role=MessageRole.USER,
-                    blocks=[text_block, image_block]
-                )
-            ]
+    return [
+        ChatMessage(
+            role=MessageRole.USER,
+            blocks=[text_block, image_block]
         )
-        return response.message.content
+    ]
+
+def _table_batch_messages(image_paths):
+    """
+    Builds one chat message asking the VLM to summarise several table images at once.
+    """
+    from llama_index.core.llms import ChatMessage, MessageRole, ImageBlock, TextBlock
+
+    prompt_text = (
+        f"Analyze these {len(image_paths)} images of financial tables, given in order. "
+        "For each one, write a comprehensive text summary of the data it contains, "
+        "including column headers and key row values, so that it can be retrieved via search. "
+        f"Respond with only a JSON array of exactly {len(image_paths)} strings, "
+        "one summary per image, in the same order as the images."
+    )
+    image_blocks = [ImageBlock(url=_image_url(p), detail="high") for p in image_paths]
+
+    return [
+        ChatMessage(
+            role=MessageRole.USER,
+            blocks=[TextBlock(text=prompt_text), *image_blocks]
+        )
+    ]
+
+def _parse_batch_summaries(content: str, expected: int):
+    """
+    Parses the JSON array returned for a batch; None if it isn't exactly `expected` strings.
+    """
+    content = re.sub(r"^```(?:json)?\s*|\s*```$", "", (content or "").strip())
+    try:
+        summaries = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(summaries, list) or len(summaries) != expected:
+        return None
+    if not all(isinstance(summary, str) and summary for summary in summaries):
+        return None
+    return summaries
+
+def _summary_cache_path(image_path: str) -> str:
+    """
+    Cache file for a table image, keyed by its bytes (not its path) and the VLM model,
+    so re-extracted crops of the same table hit the cache across runs.
+    """
+    digest = hashlib.sha256(llm.model.encode("utf-8"))
+    if VLM_GRAYSCALE and not TABLE_IMAGE_BASE_URL:
+        digest.update(b"grayscale")  # The VLM saw a different image
+    with open(image_path, "rb") as image_file:
+        digest.update(image_file.read())
+    return os.path.join(VLM_CACHE_DIR, f"{digest.hexdigest()}.txt")
+
+def _read_cached_summary(cache_path: str):
+    if os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+    return None
+
+def _write_cached_summary(cache_path: str, summary: str):
+    """
+    Caches a summary as best effort: a failed write only costs a cache miss next run.
+    Each writer gets its own temp file, so the rename is atomic for readers and writers alike.
+    """
+    tmp_path = None
+    try:
+        os.makedirs(VLM_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=VLM_CACHE_DIR,
+                                         suffix=".tmp", delete=False) as f:
+            tmp_path = f.name
+            f.write(summary)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"⚠️ Could not cache summary {os.path.basename(cache_path)}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def summarize_table_image(image_path: str) -> str:
+    """
+    Sends table image to VLM to get a text summary.
+    Sync wrapper around `asummarize_table_image`, for callers outside an event loop.
+    """
+    return asyncio.run(asummarize_table_image(image_path))
+
+async def asummarize_table_image(image_path: str) -> str:
+    """
+    Sends a table image to the VLM for a text summary, reusing the on-disk cache.
+    """
+    try:
+        cache_path = _summary_cache_path(image_path)
+        cached = _read_cached_summary(cache_path)
+        if cached is not None:
+            return cached
+
+        response = await llm.achat(messages=_table_summary_messages(image_path))
+        summary = response.message.content
+        if summary:
+            _write_cached_summary(cache_path, summary)
+        return summary
     except Exception as e:
         print(f"Error summarising {image_path}: {e}")
         return f"Error processing table: {os.path.basename(image_path)}"
 
+async def asummarize_table_images(image_paths):
+    """
+    Summarises several uncached table images in a single VLM request.
+    Falls back to one request per image if the batched answer can't be parsed; those run
+    one after another, since the caller holds a single VLM_CONCURRENCY slot for the batch.
+    """
+    if len(image_paths) == 1:
+        return [await asummarize_table_image(image_paths[0])]
+
+    try:
+        response = await llm.achat(messages=_table_batch_messages(image_paths))
+        summaries = _parse_batch_summaries(response.message.content, len(image_paths))
+    except Exception as e:
+        print(f"Error summarising batch of {len(image_paths)} tables: {e}")
+        summaries = None
+
+    if summaries is None:
+        return [await asummarize_table_image(p) for p in image_paths]
+
+    for image_path, summary in zip(image_paths, summaries):
+        try:
+            _write_cached_summary(_summary_cache_path(image_path), summary)
+        except OSError as e:  # Summary is still good; it just won't be cached
+            print(f"⚠️ Could not cache summary for {image_path}: {e}")
+    return summaries
+
+async def _summarize_tables(image_files, on_summary):
+    """
+    Summarises all table images concurrently on one event loop.
+    Cached tables are reported straight away; the rest are sent VLM_BATCH_SIZE
+    images per request, with at most VLM_CONCURRENCY requests in flight.
+    Calls `on_summary(image_path, summary)` as each one completes.
+    """
+    done = 0
+
+    def report(img_path, summary):
+        nonlocal done
+        done += 1
+        print(f"   [{done}/{len(image_files)}] Analyzed {os.path.basename(img_path)}", end="\r")
+        on_summary(img_path, summary)
+
+    uncached = []
+    for img_path in image_files:
+        cached = _read_cached_summary(_summary_cache_path(img_path))
+        if cached is not None:
+            report(img_path, cached)
+        else:
+            uncached.append(img_path)
+
+    # Every input is known up front, so batches are cut by size alone (no wait deadline needed)
+    batches = [uncached[i:i + VLM_BATCH_SIZE] for i in range(0, len(uncached), VLM_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(VLM_CONCURRENCY)
+
+    async def run(batch):
+        async with semaphore:
+            return batch, await asummarize_table_images(batch)
+
+    for task in asyncio.as_completed([run(b) for b in batches]):
+        batch, summaries = await task
+        for img_path, summary in zip(batch, summaries):
+            report(img_path, summary)
+
+def _embed_nodes(nodes):
+    """
+    Embeds nodes in place, using the same text VectorStoreIndex would embed.
+    """
+    texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    for node, embedding in zip(nodes, embed_model.get_text_embedding_batch(texts)):
+        node.embedding = embedding
+
+def _run_stage(target, node_queue, errors):
+    """
+    Runs a producer stage, recording any exception, and always signals the consumer when done.
+    """
+    try:
+        target()
+    except Exception as e:
+        errors.append(e)
+    finally:
+        node_queue.put(_STAGE_DONE)
+
+def _embed_stage(node_queue, n_producers, embedded_nodes, errors):
+    """
+    Consumer stage: embeds nodes as they arrive, flushing a batch at EMBED_BATCH_SIZE
+    nodes or EMBED_BATCH_TIMEOUT seconds after its first node, whichever comes first.
+    """
+    batch = []
+    deadline = None
+    finished = 0
+    try:
+        while finished < n_producers:
+            timeout = max(0.0, deadline - time.monotonic()) if batch else None
+            try:
+                item = node_queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None  # Deadline hit: flush what we have
+
+            if item is _STAGE_DONE:
+                finished += 1
+            elif item is not None:
+                if not batch:
+                    deadline = time.monotonic() + EMBED_BATCH_TIMEOUT
+                batch.append(item)
+
+            if batch and (item is None or len(batch) >= EMBED_BATCH_SIZE or finished == n_producers):
+                _embed_nodes(batch)
+                embedded_nodes.extend(batch)
+                batch = []
+    except Exception as e:
+        errors.append(e)
+        # Keep draining so blocked producers can finish
+        while finished < n_producers:
+            if node_queue.get() is _STAGE_DONE:
+                finished += 1
+
+def _chunk_hash(node) -> str:
+    """
+    Hash of exactly what gets embedded, so unchanged chunks can keep their vectors.
+    """
+    return hashlib.blake2b(node.get_content(metadata_mode=MetadataMode.EMBED).encode("utf-8")).hexdigest()
+
+def _load_manifest(persist_dir: str) -> dict:
+    """
+    Chunk manifest of a previous run, or {} if there is none or it was built
+    with a different embedding model / size (vectors would not be comparable).
+    """
+    path = os.path.join(persist_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("model") != embed_model.model_name or manifest.get("dimensions") != embed_model.dimensions:
+        return {}
+    return manifest.get("chunks", {})
+
+def _save_manifest(persist_dir: str, chunks: dict):
+    manifest = {"model": embed_model.model_name, "dimensions": embed_model.dimensions, "chunks": chunks}
+    with open(os.path.join(persist_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
 def build_pipeline(pdf_path, table_output_dir, persist_dir="./storage"):
     """
     Args:
         pdf_path (str): Path to the uploaded PDF.
         table_output_dir (str): Directory where extracted table images are located.
         persist_dir (str): Directory to save the vector index.
+
+    Text chunking, table summarisation and embedding run as concurrent stages
+    connected by a bounded queue, so wall-clock is roughly the slowest stage.
+
+    If `persist_dir` already holds an index from a previous run, only new or
+    changed chunks are embedded and inserted; chunks that disappeared are deleted.
     """
     print(f"🚀 Starting RAG Ingestion Pipeline for: {pdf_path}")
 
-    # 1. Load & Chunk PDF Text
-    # ---------------------------
-    from llama_index.readers.file import PDFReader
-    
     if not os.path.exists(pdf_path):
         print(f"❌ PDF not found at {pdf_path}")
         return None
 
-    print(f"📄 Loading Text from PDF...")
-    
-    # Force PDF parsing
-    parser = PDFReader()
-    file_extractor = {".pdf": parser}
-    reader = SimpleDirectoryReader(input_files=[pdf_path], file_extractor=file_extractor)
-    
-    pdf_docs = reader.load_data()
-    
-    # Create Text Nodes (Chunks)
-    splitter = SentenceSplitter(chunk_size=1024, chunk_overlap=200)
-    text_nodes = splitter.get_nodes_from_documents(pdf_docs)
-    print(f"✅ Generated {len(text_nodes)} text nodes from PDF.")
+    node_queue = queue.Queue(maxsize=NODE_QUEUE_SIZE)
+    embedded_nodes = []
+    errors = []
+    counts = {"text": 0, "table": 0}
 
-    # 2. Multimodal Table Processing (Parallelized)
+    # Chunks already embedded in persist_dir are skipped, not re-embedded
+    previous_chunks = _load_manifest(persist_dir)
+    chunks = {}  # Manifest for this run
+    chunks_lock = threading.Lock()
+
+    def enqueue(node):
+        chunk_hash = _chunk_hash(node)
+        with chunks_lock:
+            if chunk_hash in chunks:
+                return  # Duplicate chunk within this document
+            chunks[chunk_hash] = previous_chunks.get(chunk_hash, node.node_id)
+        if chunk_hash not in previous_chunks:
+            node_queue.put(node)
+
+    # 1. Load & Chunk PDF Text (CPU)
     # ---------------------------
-    image_files = glob.glob(os.path.join(table_output_dir, "*.png"))
-    table_nodes = []
-    
-    if image_files:
-        print(f"🖼️  Found {len(image_files)} table images. Starting Parallel VLM processing...")
+    def text_stage():
+        print(f"📄 Loading Text from PDF...")
         
-        import concurrent.futures
+        # PyMuPDF (native) across worker processes; same metadata keys PDFReader produced
+        file_name = os.path.basename(pdf_path)
+        pdf_docs = [
+            Document(text=text, metadata={"page_label": page_label, "file_name": file_name})
+            for page_label, text in extract_pages(pdf_path)
+            if text.strip()
+        ]
+        
+        # Create Text Nodes (Chunks)
+        splitter = SentenceSplitter(chunk_size=1024, chunk_overlap=200)
+        text_nodes = splitter.get_nodes_from_documents(pdf_docs)
+        print(f"✅ Generated {len(text_nodes)} text nodes from PDF.")
 
-        # Helper for parallel execution
-        def process_image(img_path):
-            try:
-                summary = summarize_table_image(img_path)
-                return img_path, summary
-            except Exception as e:
-                print(f"Error processing {img_path}: {e}")
-                return img_path, None
-
-        # Run with ThreadPool
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_img = {executor.submit(process_image, img): img for img in image_files}
-            
-            for i, future in enumerate(concurrent.futures.as_completed(future_to_img)):
-                img_path, summary = future.result()
-                print(f"   [{i+1}/{len(image_files)}] Analyzed {os.path.basename(img_path)}", end="\r")
-                
-                if summary:
-                    node = TextNode(text=summary)
-                    node.metadata = {
-                        "image_path": img_path,
-                        "file_name": os.path.basename(img_path),
-                        "type": "table_image",
-                        "page_num": "unknown" 
-                    }
-                    table_nodes.append(node)
-
-        print(f"\n✅ Generated {len(table_nodes)} table nodes from images.")
-    else:
-        print("ℹ️  No table images found to process.")
-
-    # 3. Embed Everything & 4. Persist
+        for node in text_nodes:
+            enqueue(node)
+        counts["text"] = len(text_nodes)
+
+    # 2. Multimodal Table Processing (remote VLM, asyncio)
     # ---------------------------
-    all_nodes = text_nodes + table_nodes
-    print(f"🧠 Embedding {len(all_nodes)} total nodes ({len(text_nodes)} text + {len(table_nodes)} tables)...")
-    
-    # Create Index
-    index = VectorStoreIndex(
-        nodes=all_nodes, 
-        show_progress=True
+    image_files = glob.glob(os.path.join(table_output_dir, "*.png"))
+
+    def table_stage():
+        if not image_files:
+            print("ℹ️  No table images found to process.")
+            return
+
+        print(f"🖼️  Found {len(image_files)} table images. Starting Async VLM processing...")
+
+        def on_summary(img_path, summary):
+            if summary:
+                node = TextNode(text=summary)
+                node.metadata = {
+                    "image_path": img_path,
+                    "file_name": os.path.basename(img_path),
+                    "type": "table_image",
+                    "page_num": "unknown" 
+                }
+                enqueue(node)
+                counts["table"] += 1
+
+        asyncio.run(_summarize_tables(image_files, on_summary))
+        print(f"\n✅ Generated {counts['table']} table nodes from images.")
+
+    # 3. Embed Everything (remote embeddings, batched as nodes arrive)
+    # ---------------------------
+    producers = [
+        threading.Thread(target=_run_stage, args=(stage, node_queue, errors), daemon=True)
+        for stage in (text_stage, table_stage)
+    ]
+    consumer = threading.Thread(
+        target=_embed_stage, args=(node_queue, len(producers), embedded_nodes, errors), daemon=True
     )
+    for thread in producers + [consumer]:
+        thread.start()
+    for thread in producers + [consumer]:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    stale_ids = [node_id for chunk_hash, node_id in previous_chunks.items() if chunk_hash not in chunks]
+    print(
+        f"🧠 Embedded {len(embedded_nodes)} new nodes ({counts['text']} text + {counts['table']} tables in document, "
+        f"{len(chunks) - len(embedded_nodes)} unchanged, {len(stale_ids)} removed)."
+    )
+    
+    # 4. Index & Persist
+    # ---------------------------
+    # Nodes already carry embeddings, so building/updating the index makes no API calls
+    index = None
+    if previous_chunks:
+        index = load_index_from_storage(load_storage_context(persist_dir))
+        if stale_ids and is_faiss_store(persist_dir):
+            # FAISS HNSW cannot delete vectors: rebuild the graph from the vectors it
+            # already stores for the unchanged chunks (no embedding calls)
+            print("ℹ️  FAISS index cannot delete stale chunks; rebuilding it from stored vectors.")
+            unchanged_ids = [chunks[h] for h in chunks if h in previous_chunks]
+            vectors = stored_embeddings(index, unchanged_ids)
+            unchanged = index.docstore.get_nodes(unchanged_ids)
+            for node in unchanged:
+                node.embedding = vectors[node.node_id]
+            embedded_nodes.extend(unchanged)
+            index = None
+        else:
+            index.insert_nodes(embedded_nodes)
+            if stale_ids:
+                index.delete_nodes(stale_ids, delete_from_docstore=True)
+
+    if index is None:
+        index = VectorStoreIndex(
+            nodes=embedded_nodes, 
+            storage_context=new_storage_context(),
+            show_progress=True
+        )
     
     # Save to Disk
     index.storage_context.persist(persist_dir=persist_dir)
+    _save_manifest(persist_dir, chunks)
     print(f"💾 Index persisted to {persist_dir}")
     print("🎉 Pipeline Finish!")
     return index
@@ -8,9 +8,20 @@ from llama_index.core.llms import (
 from llama_index.core.embeddings import BaseEmbedding
 from llama_index.core.llms.callbacks import llm_completion_callback
 from llama_index.core.base.llms.types import ChatMessage, ChatResponse
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from pydantic import PrivateAttr
+import asyncio
 import os
 
+# LlamaIndex content block -> OpenAI message part, dispatched on block.block_type
+_BLOCK_CONVERTERS = {
+    "text": lambda block: {"type": "text", "text": block.text},
+    # LlamaIndex stores images in various ways, usually url/path
+    # We need to ensure it's a URL or base64 data URL. 
+    # block.url is AnyUrl, must convert to string for JSON serialization.
+    "image": lambda block: {"type": "image_url", "image_url": {"url": str(block.url)}},
+}
+
 class OpenRouterLLM(CustomLLM):
     """
     Custom LLM wrapper for OpenRouter to bypass LlamaIndex OpenAI validation.
@@ -19,9 +30,13 @@ class OpenRouterLLM(CustomLLM):
     api_key: str
     base_url: str = "https://openrouter.ai/api/v1"
     context_window: int = 128000
+    max_retries: int = 2  # SDK retries (429/5xx/timeouts) with exponential back-off, honouring Retry-After
+    _cached_client: Optional[OpenAI] = PrivateAttr(default=None)
+    _cached_aclient: Optional[AsyncOpenAI] = PrivateAttr(default=None)
+    _cached_aclient_loop: Any = PrivateAttr(default=None)
     
-    def __init__(self, model: str, api_key: str):
-        super().__init__(model=model, api_key=api_key)
+    def __init__(self, model: str, api_key: str, max_retries: int = 2):
+        super().__init__(model=model, api_key=api_key, max_retries=max_retries)
         
     @property
     def metadata(self) -> LLMMetadata:
@@ -34,7 +49,10 @@ class OpenRouterLLM(CustomLLM):
 
     @property
     def _client(self) -> OpenAI:
-        return OpenAI(base_url=self.base_url, api_key=self.api_key)
+        # Built once and reused so every call shares the same pooled HTTP connections
+        if self._cached_client is None:
+            self._cached_client = OpenAI(base_url=self.base_url, api_key=self.api_key, timeout=60, max_retries=self.max_retries)
+        return self._cached_client
 
     @llm_completion_callback()
     def complete(self, prompt: str, **kwargs: Any) -> CompletionResponse:
@@ -62,32 +80,51 @@ class OpenRouterLLM(CustomLLM):
                 yield CompletionResponse(text=text, delta=delta)
         return gen()
 
-    def chat(self, messages: List[ChatMessage], **kwargs: Any) -> ChatResponse:
-        # Convert LlamaIndex ChatMessages to OpenAI dicts
+    @property
+    def _aclient(self) -> AsyncOpenAI:
+        # httpx async pools are bound to the event loop that created them,
+        # so rebuild the client if we are called from a new loop (e.g. a later asyncio.run)
+        loop = asyncio.get_running_loop()
+        if self._cached_aclient is None or self._cached_aclient_loop is not loop:
+            self._cached_aclient = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, timeout=60, max_retries=self.max_retries)
+            self._cached_aclient_loop = loop
+        return self._cached_aclient
+
+    @staticmethod
+    def _to_openai_messages(messages: List[ChatMessage]) -> List[Dict[str, Any]]:
+        # Convert LlamaIndex ChatMessages to OpenAI dicts (on every VLM call path)
         openai_msgs = []
         for m in messages:
             content = m.content
-            # Handle vision blocks if present (simplified)
-            if hasattr(m, 'blocks') and m.blocks:
-                content_parts = []
-                for block in m.blocks:
-                    if block.block_type == "text":
-                        content_parts.append({"type": "text", "text": block.text})
-                    elif block.block_type == "image":
-                        # LlamaIndex stores images in various ways, usually url/path
-                        # We need to ensure it's a URL or base64 data URL. 
-                        # block.url is AnyUrl, must convert to string for JSON serialization.
-                         content_parts.append({
-                            "type": "image_url",
-                            "image_url": {"url": str(block.url)} 
-                        })
-                content = content_parts
+            # Handle vision blocks if present (simplified); unknown block types are skipped
+            blocks = getattr(m, "blocks", None)
+            if blocks:
+                content = [
+                    convert(block) for block in blocks
+                    if (convert := _BLOCK_CONVERTERS.get(block.block_type))
+                ]
             
             openai_msgs.append({"role": m.role.value, "content": content})
+        return openai_msgs
 
+    def chat(self, messages: List[ChatMessage], **kwargs: Any) -> ChatResponse:
         response = self._client.chat.completions.create(
             model=self.model,
-            messages=openai_msgs,
+            messages=self._to_openai_messages(messages),
+            **kwargs
+        )
+        return ChatResponse(
+            message=ChatMessage(
+                role="assistant", 
+                content=response.choices[0].message.content
+            )
+        )
+
+    async def achat(self, messages: List[ChatMessage], **kwargs: Any) -> ChatResponse:
+        # Native async path so many VLM requests can overlap on one thread
+        response = await self._aclient.chat.completions.create(
+            model=self.model,
+            messages=self._to_openai_messages(messages),
             **kwargs
         )
         return ChatResponse(
@@ -105,13 +142,30 @@ class OpenRouterEmbedding(BaseEmbedding):
     model_name: str = "openai/text-embedding-3-small"
     api_key: str
     base_url: str = "https://openrouter.ai/api/v1"
+    # Matryoshka truncation (text-embedding-3-*). Ingest and query must use the same value.
+    dimensions: int = 512
+    _cached_client: Optional[OpenAI] = PrivateAttr(default=None)
+    _cached_aclient: Optional[AsyncOpenAI] = PrivateAttr(default=None)
+    _cached_aclient_loop: Any = PrivateAttr(default=None)
 
-    def __init__(self, api_key: str, model_name: str = "openai/text-embedding-3-small", **kwargs):
-        super().__init__(model_name=model_name, api_key=api_key, **kwargs)
+    def __init__(self, api_key: str, model_name: str = "openai/text-embedding-3-small", embed_batch_size: int = 96, dimensions: int = 512, **kwargs):
+        super().__init__(model_name=model_name, api_key=api_key, embed_batch_size=embed_batch_size, dimensions=dimensions, **kwargs)
 
     @property
     def _client(self) -> OpenAI:
-        return OpenAI(base_url=self.base_url, api_key=self.api_key)
+        # Built once and reused so every call shares the same pooled HTTP connections
+        if self._cached_client is None:
+            self._cached_client = OpenAI(base_url=self.base_url, api_key=self.api_key, timeout=60, max_retries=2)
+        return self._cached_client
+
+    @property
+    def _aclient(self) -> AsyncOpenAI:
+        # Rebuilt per event loop, see OpenRouterLLM._aclient
+        loop = asyncio.get_running_loop()
+        if self._cached_aclient is None or self._cached_aclient_loop is not loop:
+            self._cached_aclient = AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, timeout=60, max_retries=2)
+            self._cached_aclient_loop = loop
+        return self._cached_aclient
 
     def _get_query_embedding(self, query: str) -> List[float]:
         return self._get_embedding(query)
@@ -119,17 +173,49 @@ class OpenRouterEmbedding(BaseEmbedding):
     def _get_text_embedding(self, text: str) -> List[float]:
         return self._get_embedding(text)
 
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # The /embeddings endpoint accepts arrays: one request per batch instead of per text
+        embeddings = []
+        for i in range(0, len(texts), self.embed_batch_size):
+            batch = [t.replace("\n", " ") for t in texts[i:i + self.embed_batch_size]]
+            response = self._client.embeddings.create(
+                model=self.model_name,
+                input=batch,
+                encoding_format="float",
+                dimensions=self.dimensions
+            )
+            embeddings.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        return embeddings
+
     def _get_embedding(self, text: str) -> List[float]:
         text = text.replace("\n", " ")
         response = self._client.embeddings.create(
             model=self.model_name,
             input=[text],
-            encoding_format="float"
+            encoding_format="float",
+            dimensions=self.dimensions
         )
         return response.data[0].embedding
 
+    async def _aembed_batch(self, texts: List[str]) -> List[List[float]]:
+        response = await self._aclient.embeddings.create(
+            model=self.model_name,
+            input=[t.replace("\n", " ") for t in texts],
+            encoding_format="float",
+            dimensions=self.dimensions
+        )
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
     async def _aget_query_embedding(self, query: str) -> List[float]:
-        return self._get_query_embedding(query)
+        return (await self._aembed_batch([query]))[0]
 
     async def _aget_text_embedding(self, text: str) -> List[float]:
-        return self._get_text_embedding(text)
+        return (await self._aembed_batch([text]))[0]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        # All batches in flight at once instead of one after the other
+        batches = await asyncio.gather(*[
+            self._aembed_batch(texts[i:i + self.embed_batch_size])
+            for i in range(0, len(texts), self.embed_batch_size)
+        ])
+        return [embedding for batch in batches for embedding in batch]
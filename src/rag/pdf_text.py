@@ -0,0 +1,38 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
+
+# Kept free of LlamaIndex imports so spawned workers start quickly.
+
+PAGES_PER_TASK = 16  # Pages each worker extracts per task
+POOL_MIN_PAGES = 200  # Below this, spawning workers costs more than it saves (80 pages: 0.44s pooled vs 0.20s)
+
+def _extract_page_range(task):
+    """Worker: opens the PDF itself (document handles can't cross processes)."""
+    pdf_path, start, stop = task
+    with fitz.open(pdf_path) as doc:
+        return [
+            (doc[i].get_label() or str(i + 1), doc[i].get_text())
+            for i in range(start, stop)
+        ]
+
+def extract_pages(pdf_path, max_workers=None):
+    """
+    Extracts text per page with PyMuPDF; long documents spread page ranges over worker processes.
+    Returns a list of (page_label, text), one per page, in page order.
+    """
+    with fitz.open(pdf_path) as doc:
+        n_pages = len(doc)
+
+    tasks = [
+        (pdf_path, start, min(start + PAGES_PER_TASK, n_pages))
+        for start in range(0, n_pages, PAGES_PER_TASK)
+    ]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    if n_pages < POOL_MIN_PAGES or max_workers <= 1:
+        return [page for task in tasks for page in _extract_page_range(task)]
+
+    # spawn, not fork: ingestion runs this from a thread alongside other threads
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return [page for pages in executor.map(_extract_page_range, tasks) for page in pages]
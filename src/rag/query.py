@@ -1,15 +1,21 @@
 import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from dotenv import load_dotenv
 from llama_index.core import (
     Settings,
-    StorageContext,
     load_index_from_storage,
     VectorStoreIndex,
 )
+from llama_index.core.schema import QueryBundle
 try:
     from src.rag.openrouter_client import OpenRouterLLM, OpenRouterEmbedding
+    from src.rag.vector_store import EMBED_DIM, index_dimensions, load_storage_context
 except ImportError:
     from openrouter_client import OpenRouterLLM, OpenRouterEmbedding
+    from vector_store import EMBED_DIM, index_dimensions, load_storage_context
 
 # Load env variables
 load_dotenv()
@@ -27,32 +33,120 @@ llm = OpenRouterLLM(
 embed_model = OpenRouterEmbedding(
     model_name="openai/text-embedding-3-small", 
     api_key=OPENROUTER_API_KEY,
+    dimensions=EMBED_DIM,
 )
 
 Settings.llm = llm
 Settings.embed_model = embed_model
 
-def query_system(user_query: str, persist_dir: str = "./storage") -> dict:
+# --- Caches ---
+ANSWER_CACHE_SIZE = 1024
+ANSWER_CACHE_TTL = 3600  # seconds
+EMBED_CACHE_SIZE = 4096
+INDEX_CACHE_SIZE = 4  # Loaded indexes are large; keep only a few storage dirs in memory
+
+# persist_dir -> (storage_mtime, index)
+_index_cache = OrderedDict()
+# (persist_dir, query) -> (created_at, storage_mtime, result)
+_answer_cache = OrderedDict()
+# blake2b(query) -> embedding
+_embed_cache = OrderedDict()
+_cache_lock = threading.Lock()  # Streamlit sessions run on separate threads
+
+def _storage_mtime(persist_dir: str) -> float:
+    """Latest modification time of the persisted index files (changes on re-ingest)."""
+    return max(
+        (os.path.getmtime(os.path.join(persist_dir, f)) for f in os.listdir(persist_dir)),
+        default=0.0,
+    )
+
+def get_index(persist_dir: str = "./storage") -> VectorStoreIndex:
+    """
+    Loads the persisted index once and reuses it until the files on disk change.
+    """
+    storage_mtime = _storage_mtime(persist_dir)
+    with _cache_lock:
+        cached = _index_cache.get(persist_dir)
+        if cached and cached[0] == storage_mtime:
+            _index_cache.move_to_end(persist_dir)
+            return cached[1]
+
+    storage_context = load_storage_context(persist_dir)
+    index = load_index_from_storage(storage_context)
+    with _cache_lock:
+        _index_cache[persist_dir] = (storage_mtime, index)
+        _index_cache.move_to_end(persist_dir)
+        if len(_index_cache) > INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    return index
+
+def _embed_model_for(dimensions: int) -> OpenRouterEmbedding:
+    """Query embeddings must match the index's size, which may predate EMBED_DIMENSIONS."""
+    if dimensions == embed_model.dimensions:
+        return embed_model
+    return embed_model.model_copy(update={"dimensions": dimensions})
+
+def _get_query_embedding(user_query: str, dimensions: int = EMBED_DIM):
+    """Embeds the query, reusing the vector for repeated questions."""
+    key = hashlib.blake2b(f"{dimensions}:{user_query}".encode("utf-8")).hexdigest()
+    with _cache_lock:
+        if key in _embed_cache:
+            _embed_cache.move_to_end(key)
+            return _embed_cache[key]
+
+    embedding = _embed_model_for(dimensions).get_query_embedding(user_query)
+    with _cache_lock:
+        _embed_cache[key] = embedding
+        if len(_embed_cache) > EMBED_CACHE_SIZE:
+            _embed_cache.popitem(last=False)
+    return embedding
+
+def _cache_answer(cache_key, storage_mtime: float, result: dict):
+    with _cache_lock:
+        _answer_cache[cache_key] = (time.time(), storage_mtime, result)
+        if len(_answer_cache) > ANSWER_CACHE_SIZE:
+            _answer_cache.popitem(last=False)
+
+def query_system(user_query: str, persist_dir: str = "./storage", stream: bool = False) -> dict:
     """
     Takes a user query, retrieves relevant context (text + table summaries),
     and returns the answer along with source image paths.
+
+    With `stream=True`, "response_text" is a generator of text deltas
+    (e.g. for `st.write_stream`); sources are available immediately.
     """
     
     # 1. Load the Index
     if not os.path.exists(persist_dir) or not os.listdir(persist_dir):
         return {"response": "Error: Storage not found. Run ingest.py first.", "images": []}
 
-    storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
-    index = load_index_from_storage(storage_context)
+    # Answer cache: exact repeat of a question against an unchanged index
+    cache_key = (persist_dir, user_query)
+    storage_mtime = _storage_mtime(persist_dir)
+    with _cache_lock:
+        cached = _answer_cache.get(cache_key)
+        if cached:
+            created_at, cached_mtime, cached_result = cached
+            if time.time() - created_at < ANSWER_CACHE_TTL and cached_mtime == storage_mtime:
+                _answer_cache.move_to_end(cache_key)
+                result = dict(cached_result)
+                if stream:
+                    result["response_text"] = iter([result["response_text"]])
+                return result
+            del _answer_cache[cache_key]
+
+    index = get_index(persist_dir)
     
     # 2. Retrieve Context
     # We use the lower-level retriever to inspect nodes manually
     retriever = index.as_retriever(similarity_top_k=15)
-    nodes = retriever.retrieve(user_query)
+    query_embedding = _get_query_embedding(user_query, index_dimensions(index))
+    query_bundle = QueryBundle(user_query, embedding=query_embedding)
+    nodes = retriever.retrieve(query_bundle)
     
     # 3. Process Retrieved Nodes
-    context_str = ""
-    retrieved_images = []
+    context_parts = []
+    seen_images = {}  # Insertion-ordered set of image paths
     
     for node in nodes:
         # Extract Metadata
@@ -61,15 +155,13 @@ def query_system(user_query: str, persist_dir: str = "./storage") -> dict:
         
         # Accumulate text with clear headers for the LLM
         if "image_path" in node.metadata:
-             context_str += f"\n--- Source: Table Image ({file_name}) ---\n{node.text}\n"
+             context_parts.append(f"\n--- Source: Table Image ({file_name}) ---\n{node.text}\n")
+             seen_images.setdefault(node.metadata["image_path"], None)
         else:
-             context_str += f"\n--- Source: Text (Page {page}) ---\n{node.text}\n"
-        
-        # Check for image metadata
-        if "image_path" in node.metadata:
-            img_path = node.metadata["image_path"]
-            if img_path not in retrieved_images:
-                retrieved_images.append(img_path)
+             context_parts.append(f"\n--- Source: Text (Page {page}) ---\n{node.text}\n")
+    
+    context_str = "".join(context_parts)
+    retrieved_images = list(seen_images)
     
     # 4. Synthesize Answer
     system_prompt = (
@@ -86,14 +178,27 @@ def query_system(user_query: str, persist_dir: str = "./storage") -> dict:
         "Answer:"
     )
     
-    response = llm.complete(full_prompt)
-    
-    return {
-        "response_text": response.text,
+    result = {
         "source_images": retrieved_images,
         "context_used": context_str # Optional: for debug
     }
 
+    if stream:
+        def gen():
+            text = ""
+            for chunk in llm.stream_complete(full_prompt):
+                text += chunk.delta
+                yield chunk.delta
+            # Only cache answers that were streamed to completion
+            _cache_answer(cache_key, storage_mtime, {**result, "response_text": text})
+        return {**result, "response_text": gen()}
+
+    response = llm.complete(full_prompt)
+    result["response_text"] = response.text
+    _cache_answer(cache_key, storage_mtime, result)
+
+    return dict(result)
+
 if __name__ == "__main__":
     # Test CLI
     q = "What was the total net sales in 2024?"
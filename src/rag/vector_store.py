@@ -0,0 +1,68 @@
+import os
+from llama_index.core import StorageContext
+
+# FAISS is optional: without it we fall back to LlamaIndex's in-memory SimpleVectorStore
+try:
+    import faiss
+    from llama_index.vector_stores.faiss import FaissVectorStore
+except ImportError:
+    faiss = None
+
+# --- Configuration ---
+EMBED_DIM = int(os.getenv("EMBED_DIMENSIONS", "512"))  # text-embedding-3-small, truncated (native 1536)
+HNSW_M = 32  # Graph neighbours per node
+HNSW_EF_SEARCH = 64  # Search breadth (>= similarity_top_k)
+VECTOR_STORE_FILE = "default__vector_store.json"  # Same name for both stores
+
+def new_storage_context() -> StorageContext:
+    """
+    Fresh storage context for ingestion: FAISS HNSW if installed, else SimpleVectorStore.
+    """
+    if faiss is None:
+        return StorageContext.from_defaults()
+
+    # Embeddings are unit-normalised, so inner product ranks like cosine similarity
+    faiss_index = faiss.IndexHNSWFlat(EMBED_DIM, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    faiss_index.hnsw.efSearch = HNSW_EF_SEARCH
+    return StorageContext.from_defaults(vector_store=FaissVectorStore(faiss_index=faiss_index))
+
+def is_faiss_store(persist_dir: str) -> bool:
+    """
+    SimpleVectorStore persists JSON; FaissVectorStore writes a binary index to the same file.
+    """
+    with open(os.path.join(persist_dir, VECTOR_STORE_FILE), "rb") as f:
+        return f.read(1) != b"{"
+
+def index_dimensions(index) -> int:
+    """
+    Embedding size an existing index was built with (older indexes are 1536-d).
+    """
+    vector_store = index.vector_store
+    if faiss is not None and isinstance(vector_store, FaissVectorStore):
+        return vector_store.client.d
+    embeddings = vector_store.data.embedding_dict
+    return len(next(iter(embeddings.values()))) if embeddings else EMBED_DIM
+
+def stored_embeddings(index, node_ids) -> dict:
+    """
+    Vectors a FAISS-backed index already holds for `node_ids`, read back with
+    `reconstruct` (HNSW keeps the raw vectors), so rebuilding needs no embedding calls.
+    """
+    faiss_ids = {node_id: int(faiss_id) for faiss_id, node_id in index.index_struct.nodes_dict.items()}
+    faiss_index = index.vector_store.client
+    return {node_id: faiss_index.reconstruct(faiss_ids[node_id]).tolist() for node_id in node_ids}
+
+def load_storage_context(persist_dir: str) -> StorageContext:
+    """
+    Storage context for a persisted index, whichever vector store it was built with.
+    """
+    if not is_faiss_store(persist_dir):
+        return StorageContext.from_defaults(persist_dir=persist_dir)
+
+    if faiss is None:
+        raise ImportError(
+            f"Index at {persist_dir} was built with FAISS. "
+            "Run: pip install faiss-cpu llama-index-vector-stores-faiss"
+        )
+    vector_store = FaissVectorStore.from_persist_dir(persist_dir)
+    return StorageContext.from_defaults(vector_store=vector_store, persist_dir=persist_dir)
@@ -0,0 +1,106 @@
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import Image
+
+# Kept free of torch/ultralytics imports so spawned workers start quickly.
+
+DETECT_LONG_SIDE = 1584  # Detection render cap (px, long side): US Letter at 2x; smaller lost tables in testing
+CROP_SCALE = 2  # Table crops are re-rendered at 2x (144 DPI) so they stay sharp
+POOL_MIN_PAGES = 16  # Below this, spawning workers costs more than it saves
+PAGES_IN_FLIGHT_PER_WORKER = 2  # Bounds rendered pages waiting on the consumer
+MIN_TEXT_BLOCKS = 2  # Pages without images and below both minimums are blank/near-empty and never rendered
+MIN_RULING_LINES = 4
+
+# PyMuPDF must not be driven from several threads at once: in-process page
+# renders and crop re-renders on the inference thread take turns through this lock
+_fitz_lock = threading.Lock()
+
+# Each pool worker's own handle (documents can't cross processes). Pages arrive
+# document by document, so one open document per worker is enough.
+_worker_doc = None
+_worker_doc_path = None
+
+def _may_hold_table(page):
+    """
+    Cheap pre-filter. Pages with images are always kept (scanned filings have no text
+    or drawings, only a raster); text blocks are checked before the costlier drawings.
+    """
+    if page.get_images() or len(page.get_text("blocks")) >= MIN_TEXT_BLOCKS:
+        return True
+    ruling = sum(1 for path in page.get_drawings() for item in path["items"] if item[0] in ("l", "re", "qu"))
+    return ruling >= MIN_RULING_LINES
+
+def _render(doc, page_num):
+    """Raw detection render of a page, or None if the page can't hold a table."""
+    page = doc[page_num]
+    if not _may_hold_table(page):
+        return None
+    scale = min(DETECT_LONG_SIDE / max(page.rect.width, page.rect.height), CROP_SCALE)
+    pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale))
+    # One fresh bytes copy per page is deliberate. Copying into a reused scratch buffer
+    # measured ~2x slower (it adds a full-page copy), and SharedMemory slots for the pool
+    # would need ~150 MB of /dev/shm at 3 batches in flight (Docker defaults to 64 MB).
+    return page_num, pix.samples, pix.height, pix.width, pix.n, scale
+
+def _render_in_worker(pdf_path, page_num):
+    global _worker_doc, _worker_doc_path
+    if pdf_path != _worker_doc_path:
+        if _worker_doc is not None:
+            _worker_doc.close()
+        _worker_doc, _worker_doc_path = fitz.open(pdf_path), pdf_path
+    return _render(_worker_doc, page_num)
+
+def _as_page(doc_idx, rendered):
+    page_num, samples, height, width, channels, scale = rendered
+    # The array wraps the sample bytes without copying (RGB, HxWx3)
+    img = np.frombuffer(samples, dtype=np.uint8).reshape(height, width, channels)
+    return doc_idx, page_num, img, scale
+
+def iter_pages(docs, max_workers=None):
+    """
+    Renders pages of one or more `(pdf_path, doc)` for detection, spreading pages over
+    worker processes. Yields (doc_idx, page_num, RGB array, scale) in document and page
+    order, skipping pages that can't hold a table; the `doc`s are used for short runs.
+    """
+    tasks = [(doc_idx, pdf_path, page_num)
+             for doc_idx, (pdf_path, doc) in enumerate(docs)
+             for page_num in range(len(doc))]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(tasks))
+    if len(tasks) < POOL_MIN_PAGES or max_workers <= 1:
+        for doc_idx, _, page_num in tasks:
+            with _fitz_lock:
+                rendered = _render(docs[doc_idx][1], page_num)
+            if rendered is not None:
+                yield _as_page(doc_idx, rendered)
+        return
+
+    # spawn, not fork: this runs on a thread alongside the inference thread.
+    # One pool for the whole run, so later documents don't pay worker start-up again.
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        # Submit through a bounded window, so a slow consumer can't pile up rendered pages
+        pending = deque()
+        try:
+            for doc_idx, pdf_path, page_num in tasks:
+                pending.append((doc_idx, executor.submit(_render_in_worker, pdf_path, page_num)))
+                if len(pending) >= max_workers * PAGES_IN_FLIGHT_PER_WORKER:
+                    done_idx, future = pending.popleft()
+                    if (rendered := future.result()) is not None:
+                        yield _as_page(done_idx, rendered)
+            while pending:
+                done_idx, future = pending.popleft()
+                if (rendered := future.result()) is not None:
+                    yield _as_page(done_idx, rendered)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def render_crop(doc, page_num, rect):
+    """Renders just the `rect` region (page coordinates) of a page at `CROP_SCALE`."""
+    with _fitz_lock:
+        pix = doc[page_num].get_pixmap(matrix=fitz.Matrix(CROP_SCALE, CROP_SCALE), clip=rect)
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
@@ -1,65 +1,299 @@
 import fitz  # PyMuPDF
+import numpy as np
+import torch
 from ultralytics import YOLO
 from PIL import Image
 import os
+import re
 import shutil
+import uuid
+from pathlib import Path
+import queue
+import threading
+import gc
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from src.vision.page_renderer import CROP_SCALE, iter_pages, render_crop
+except ImportError:
+    from page_renderer import CROP_SCALE, iter_pages, render_crop
+
+# TensorRT is optional: without it (or without CUDA) the PyTorch weights are used
+try:
+    import tensorrt
+except ImportError:
+    tensorrt = None
+
+DEFAULT_BATCH_SIZE = 8  # Pages per YOLO forward pass
+SAVE_WORKERS = 4  # Threads encoding table crops (zlib releases the GIL)
+PNG_COMPRESS_LEVEL = 1  # Fast zlib: much quicker crop encodes for somewhat larger files (often uploaded as saved)
+MAX_DETECTIONS = 50  # Per page; a 10-K page holds a handful of tables at most
+RELEASE_EVERY = 8  # Batches between gc / CUDA cache releases
+USE_TENSORRT = os.getenv("VISION_TENSORRT", "1") != "0"  # Set to 0 to skip engine export
+TRT_MAX_BATCH = 16  # Largest batch the exported engine accepts
+
+_RENDER_DONE = object()  # Sentinel the render thread puts on the queue when finished
+
+def _render_pages(docs, page_queue, errors, stop):
+    """
+    Producer: feeds pages rendered by `iter_pages` (worker processes) into `page_queue`
+    while the caller runs inference. Crops come from `render_crop`.
+    """
+    try:
+        with closing(iter_pages(docs)) as pages:
+            for page in pages:
+                if stop.is_set():
+                    break
+                page_queue.put(page)
+    except Exception as e:
+        errors.append(e)
+    finally:
+        page_queue.put(_RENDER_DONE)
+
+def _remove_dirs(paths):
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+def _iter_batches(page_queue, batch_size):
+    """Groups rendered pages into batches of up to `batch_size` (the last may be partial)."""
+    batch = []
+    while (item := page_queue.get()) is not _RENDER_DONE:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _select_device():
+    """CUDA (FP16) > Apple MPS > CPU."""
+    if torch.cuda.is_available():
+        return "cuda:0"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+def _tensorrt_engine(model_path, device):
+    """
+    FP16 TensorRT engine for this GPU, exported next to the weights on first use.
+    Engines only run on the GPU and TensorRT version that built them, so both are in the name.
+    Returns None when TensorRT isn't available.
+    """
+    if tensorrt is None or not USE_TENSORRT or not device.startswith("cuda"):
+        return None
+
+    model_path = Path(model_path)
+    gpu = re.sub(r"[^A-Za-z0-9]+", "_", torch.cuda.get_device_name(device))
+    engine_path = model_path.with_name(f"{model_path.stem}.{gpu}.trt{tensorrt.__version__}.engine")
+    if not engine_path.exists():
+        print(f"⚙️  Exporting TensorRT engine for {gpu} (one-off, takes a few minutes)...")
+        try:
+            exported = YOLO(str(model_path)).export(
+                format="engine", half=True, dynamic=True, batch=TRT_MAX_BATCH,
+                workspace=4, device=device, verbose=False
+            )
+            os.replace(exported, engine_path)
+        except Exception as e:
+            print(f"⚠️  TensorRT export failed, using PyTorch weights: {e}")
+            return None
+    return engine_path
 
 class VisionProcessor:
-    def __init__(self, model_path="models/table_detector.pt", output_dir="data/processed_tables"):
+    # Loaded models shared by every instance: (model_path, device) -> (YOLO, predict lock, max batch)
+    _model_cache = {}
+    _model_cache_lock = threading.Lock()
+
+    def __init__(self, model_path="models/table_detector.pt", output_dir="data/processed_tables", batch_size=DEFAULT_BATCH_SIZE, verbose=False):
         # Verify model exists
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"❌ Model not found at {model_path}. Run src/download_weights.py first!")
             
-        print(f"👁️  Loading Vision Model: {model_path}...")
-        self.model = YOLO(model_path)
+        self.device = _select_device()
+        self.half = self.device.startswith("cuda")  # FP16 only pays off (and is supported) on CUDA
+        self.model, self._lock, max_batch = self._load_model(model_path, self.device)
+        self.batch_size = min(batch_size, max_batch or batch_size)
+        self.verbose = verbose  # Per-page detection messages
         
-        # Output setup
+        # Default output dir; prepared per run so one loaded model can serve many documents
         self.output_dir = output_dir
-        if os.path.exists(self.output_dir):
-            shutil.rmtree(self.output_dir) # Cleanup old runs
-        os.makedirs(self.output_dir, exist_ok=True)
 
-    def process_pdf(self, pdf_path):
+    @classmethod
+    def _load_model(cls, model_path, device):
+        """Loads weights once per (model_path, device); later instances reuse them."""
+        key = (os.path.abspath(model_path), device)
+        with cls._model_cache_lock:
+            if key not in cls._model_cache:
+                engine_path = _tensorrt_engine(model_path, device)
+                if engine_path is not None:
+                    print(f"👁️  Loading Vision Model: {engine_path}...")
+                    model = YOLO(str(engine_path), task="detect")
+                    max_batch = TRT_MAX_BATCH
+                else:
+                    print(f"👁️  Loading Vision Model: {model_path}...")
+                    model = YOLO(model_path)
+                    # Move and fuse Conv+BN once here, instead of letting the first predict() do it
+                    model.to(device)
+                    model.fuse()
+                    max_batch = None
+                # Warm-up pass builds the predictor (and cuDNN autotunes) before the first document
+                model.predict(
+                    np.zeros((640, 640, 3), dtype=np.uint8), verbose=False,
+                    half=device.startswith("cuda"), device=device, max_det=MAX_DETECTIONS
+                )
+                # Ultralytics predictors are not thread-safe, so the lock travels with the model
+                cls._model_cache[key] = (model, threading.Lock(), max_batch)
+            return cls._model_cache[key]
+
+    def _prepare_output_dir(self, output_dir):
+        """Swaps in an empty output dir; old runs are deleted on a background thread."""
+        output_dir = Path(output_dir)
+        if output_dir.exists():
+            # Renaming is instant, where rmtree can block for seconds on network filesystems
+            output_dir.rename(output_dir.with_name(f"{output_dir.name}.old-{uuid.uuid4().hex[:8]}"))
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        # Also sweeps sidecars left behind if an earlier cleanup was cut short by exit
+        stale = list(output_dir.parent.glob(f"{output_dir.name}.old-*"))
+        if stale:
+            threading.Thread(target=_remove_dirs, args=(stale,), daemon=True).start()
+        return output_dir
+
+    def process_pdf(self, pdf_path, output_dir=None):
         """Main pipeline: PDF Page -> Image -> YOLO Detect -> Crop Table"""
         if not os.path.exists(pdf_path):
             print(f"❌ PDF not found: {pdf_path}")
             return []
 
-        doc = fitz.open(pdf_path)
-        print(f"📄 Processing {len(doc)} pages from {pdf_path}...")
+        output_dir = output_dir or self.output_dir
+        with self._lock:
+            return self._process_pdfs([(pdf_path, output_dir)])[0]
+
+    def process_pdfs(self, pdf_paths, output_dir=None):
+        """
+        Several PDFs through one pipeline, so inference batches stay full across documents.
+        Tables go to `<output_dir>/<pdf stem>/`; returns {pdf_path: [table paths]}.
+        """
+        output_dir = Path(output_dir or self.output_dir)
+        extracted = {pdf_path: [] for pdf_path in pdf_paths}
+        jobs = []
+        for pdf_path in extracted:
+            if not os.path.exists(pdf_path):
+                print(f"❌ PDF not found: {pdf_path}")
+                continue
+            jobs.append((pdf_path, output_dir / Path(pdf_path).stem))
+
+        job_dirs = [job_dir for _, job_dir in jobs]
+        if len(set(job_dirs)) != len(job_dirs):
+            raise ValueError("❌ PDFs with the same file name would share an output folder")
+        if not jobs:
+            return extracted
+
+        with self._lock:
+            tables = self._process_pdfs(jobs)
+        extracted.update((pdf_path, found) for (pdf_path, _), found in zip(jobs, tables))
+        return extracted
+
+    def _process_pdfs(self, jobs):
+        """Runs [(pdf_path, output_dir)] through one render -> detect -> save pipeline."""
+        output_dirs = [self._prepare_output_dir(output_dir) for _, output_dir in jobs]
+
+        docs = []
+        for pdf_path, _ in jobs:
+            doc = fitz.open(pdf_path)
+            print(f"📄 Processing {len(doc)} pages from {pdf_path}...")
+            docs.append((pdf_path, doc))
         
-        tables_found = 0
-        extracted_tables = []
+        extracted_tables = [[] for _ in jobs]
+
+        # 1. Render pages in worker processes, fed through a background thread
+        #    (bounded queue keeps ~2 batches in memory)
+        page_queue = queue.Queue(maxsize=2 * self.batch_size)
+        errors = []
+        stop = threading.Event()
+        renderer = threading.Thread(target=_render_pages, args=(docs, page_queue, errors, stop), daemon=True)
+        renderer.start()
         
-        # Loop through pages
-        for page_num, page in enumerate(doc):
-            # 1. Render page to high-res image (300 DPI equivalent)
-            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2)) 
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+        try:
+            # PNG encoding runs on a pool so it overlaps with the next batch's inference
+            with ThreadPoolExecutor(max_workers=SAVE_WORKERS) as save_pool, torch.inference_mode():
+                saves = self._detect_tables(docs, page_queue, output_dirs, extracted_tables, save_pool)
+            for save in saves:
+                save.result()  # Surface write errors
+        finally:
+            # If inference failed part-way, unblock the renderer so it can exit
+            stop.set()
+            while renderer.is_alive():
+                try:
+                    page_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            for _, doc in docs:
+                doc.close()
+        if errors:
+            raise errors[0]
+
+        for output_dir, tables in zip(output_dirs, extracted_tables):
+            print(f"\n✅ Done! Extracted {len(tables)} tables to '{output_dir}'")
+        return extracted_tables
+
+    def _detect_tables(self, docs, page_queue, output_dirs, extracted_tables, save_pool):
+        """
+        Consumer: batched YOLO inference on rendered pages (batches may span documents),
+        queueing each table crop for saving. Returns the save futures.
+        """
+        saves = []
+        for batch_num, batch in enumerate(_iter_batches(page_queue, self.batch_size), start=1):
+            doc_idxs, page_nums, imgs, scales = zip(*batch)
             
-            # 2. Run YOLO Inference
-            results = self.model.predict(img, conf=0.25, verbose=False)
+            # 2. Run YOLO Inference (one batched forward pass, overlapping the next render)
+            # Results stream per page but are gathered per batch, so memory stays bounded by the batch.
+            # Ultralytics reads NumPy input as BGR, so pass a reversed-channel view (no copy).
+            results = list(self.model.predict(
+                [img[..., ::-1] for img in imgs], conf=0.25, verbose=False, stream=True,
+                batch=self.batch_size, half=self.half, device=self.device,
+                max_det=MAX_DETECTIONS, augment=False
+            ))
             
-            # 3. Process Detections
-            for result in results:
-                for box in result.boxes:
-                    coords = box.xyxy.cpu().tolist()
-                    x1, y1, x2, y2 = map(int, coords[0])
+            # 3. Process Detections: one (N, 4) array for the whole batch, one device->host copy
+            counts = [len(r.boxes) for r in results]
+            if self.verbose:
+                for doc_idx, page_num, count in zip(doc_idxs, page_nums, counts):
+                    if count:
+                        print(f"   📸 Found {count} table(s) on Page {page_num+1} of {os.path.basename(docs[doc_idx][0])}")
+            if sum(counts):
+                boxes = torch.cat([r.boxes.xyxy for r in results]).cpu().numpy()
+                page_idx = np.repeat(np.arange(len(results)), counts)
+                # Clip to each page's pixel bounds; page coordinates are for re-rendered crops
+                bounds = np.array([[img.shape[1], img.shape[0]] * 2 for img in imgs])[page_idx]
+                boxes = np.clip(boxes, 0, bounds)
+                page_boxes = boxes / np.asarray(scales)[page_idx, None]
+                pixel_boxes = boxes.astype(np.int32)
+                for i, (x1, y1, x2, y2), page_box in zip(page_idx, pixel_boxes, page_boxes):
+                    doc_idx, page_num = doc_idxs[i], page_nums[i]
+                    if scales[i] == CROP_SCALE:
+                        # Page was already rendered at crop resolution: slice it, no re-render
+                        table_crop = Image.fromarray(imgs[i][y1:y2, x1:x2])
+                    else:
+                        # Re-render only the table region at crop resolution
+                        table_crop = render_crop(docs[doc_idx][1], page_num, fitz.Rect(*page_box))
                     
-                    # Crop the table from the page
-                    table_crop = img.crop((x1, y1, x2, y2))
-                    
-                    # Save locally
-                    filename = f"p{page_num+1}_table_{tables_found}.png"
-                    save_path = os.path.join(self.output_dir, filename)
-                    table_crop.save(save_path)
-                    
-                    # print(f"   📸 Found Table on Page {page_num+1} -> Saved: {filename}")
-                    extracted_tables.append(save_path)
-                    tables_found += 1
+                    # Save locally (tables are numbered per document)
+                    doc_tables = extracted_tables[doc_idx]
+                    filename = f"p{page_num+1}_table_{len(doc_tables)}.png"
+                    save_path = output_dirs[doc_idx] / filename
+                    saves.append(save_pool.submit(
+                        table_crop.save, save_path, format="PNG", compress_level=PNG_COMPRESS_LEVEL
+                    ))
+                    doc_tables.append(str(save_path))
 
-        print(f"\n✅ Done! Extracted {tables_found} tables to '{self.output_dir}'")
-        return extracted_tables
+            # Drop this batch's pixmaps and Results before waiting on the next one,
+            # so at most one batch (plus the render queue) is alive at a time
+            del batch, imgs, results
+            if batch_num % RELEASE_EVERY == 0:
+                gc.collect()
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+        return saves
 
 if __name__ == "__main__":
     # Test run